@@ -7,12 +7,30 @@ Author: GitHub Copilot
 Date: July 24, 2025
 """
 
+# Cooperative sockets for gunicorn's gevent workers; must patch before
+# ssl/socket users (openai, httpx, requests) are imported
+try:
+    from gevent import monkey
+    monkey.patch_all()
+except ImportError:
+    pass
+
+import atexit
 import os
 import json
+import gzip
+import hashlib
 import logging
+import logging.handlers
+import queue
+import re
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, fields, replace
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from types import MappingProxyType
+from typing import Callable, Dict, List, Any, Optional
 
 # Load environment variables
 try:
@@ -22,13 +40,20 @@ except ImportError:
     pass
 
 # Minimal imports for cloud deployment
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, has_request_context, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from cachetools import TTLCache
+from tenacity import (
+    before_sleep_log, retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+)
 
 # Azure OpenAI (primary)
 try:
     from openai import AzureOpenAI
-    from azure.identity import DefaultAzureCredential
+    from azure.identity import (
+        ChainedTokenCredential, EnvironmentCredential, ManagedIdentityCredential, get_bearer_token_provider
+    )
     AZURE_AVAILABLE = True
 except ImportError:
     AZURE_AVAILABLE = False
@@ -40,22 +65,349 @@ try:
 except ImportError:
     STANDARD_OPENAI_AVAILABLE = False
 
-# Configure logging for cloud
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Shared HTTP connection pool for the AI clients (httpx ships with openai)
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    HTTPX_AVAILABLE = False
+
+# HTTP/2 multiplexing needs the optional h2 package (httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Aho-Corasick keyword matcher (optional, falls back to a compiled regex)
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+# Response compression (optional)
+try:
+    from flask_compress import Compress
+    COMPRESS_AVAILABLE = True
+except ImportError:
+    COMPRESS_AVAILABLE = False
+
+# Fast JSON encode/decode (optional, falls back to the stdlib json module)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Prometheus exposition (optional, enables /metrics)
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+    from prometheus_client.core import CounterMetricFamily
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+
+# NumPy (optional, enables the semantic response cache)
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+if ORJSON_AVAILABLE:
+    def dumps_json(obj: Any, sort_keys: bool = False, default: Optional[Callable] = None) -> bytes:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+
+    loads_json = orjson.loads
+
+    class OrjsonProvider(JSONProvider):
+        """Flask JSON provider backed by orjson; jsonify and request.get_json both use it"""
+
+        def dumps(self, obj: Any, **kwargs: Any) -> str:
+            return orjson.dumps(obj).decode()
+
+        def loads(self, s, **kwargs: Any) -> Any:
+            return orjson.loads(s)
+
+        def response(self, *args: Any, **kwargs: Any) -> Response:
+            # Hand orjson's bytes straight to the response, skipping the str round-trip
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
+else:
+    def dumps_json(obj: Any, sort_keys: bool = False, default: Optional[Callable] = None) -> bytes:
+        return json.dumps(obj, sort_keys=sort_keys, default=default).encode()
+
+    loads_json = json.loads
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line; fields passed via extra= become top-level keys"""
+
+    _RESERVED = frozenset(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            'ts': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in self._RESERVED:
+                payload[key] = value
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        return dumps_json(payload, default=str).decode()
+
+# Health/metrics probes arrive constantly; their access-log lines are noise. Only the
+# access logger is filtered: a probe may be the first request and run client
+# initialization, whose INFO lines must still be written.
+_QUIET_PATHS = frozenset({'/api/health', '/api/metrics', '/metrics'})
+_ACCESS_LOGGERS = frozenset({'werkzeug', 'gunicorn.access'})
+
+class QuietProbeFilter(logging.Filter):
+    """Drop sub-WARNING access-log records for health/metrics probes"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or record.name not in _ACCESS_LOGGERS:
+            return True
+        return not (has_request_context() and request.path in _QUIET_PATHS)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records as-is so message formatting also happens on the listener thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+# Configure logging for cloud: request code only enqueues records; a listener
+# thread formats them and writes to stderr
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(JsonLogFormatter())
+_log_queue_handler = DeferredQueueHandler(queue.SimpleQueue())
+_log_queue_handler.addFilter(QuietProbeFilter())
+_log_listener = None
+
+def _start_log_listener():
+    """Start the log writer thread; re-run in forked workers, which don't inherit threads"""
+    global _log_listener
+    
+    _log_queue_handler.queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(
+        _log_queue_handler.queue, _log_stream_handler, respect_handler_level=True
+    )
+    _log_listener.start()
+
+logging.basicConfig(level=logging.INFO, handlers=[_log_queue_handler])
+_start_log_listener()
+os.register_at_fork(after_in_child=_start_log_listener)
+atexit.register(lambda: _log_listener.stop())
 logger = logging.getLogger(__name__)
 
 # Flask app setup
 app = Flask(__name__)
+if ORJSON_AVAILABLE:
+    app.json = OrjsonProvider(app)
 CORS(app)
+if COMPRESS_AVAILABLE:
+    # Gzip would buffer Server-Sent Events, so leave streamed responses alone
+    app.config['COMPRESS_STREAMS'] = False
+    Compress(app)
+
+# Environment-driven settings, resolved once at startup
+AZURE_CHAT_MODEL = os.getenv('AZURE_OPENAI_CHAT_MODEL', 'gpt-4')
+AZURE_EMBEDDING_MODEL = os.getenv('AZURE_OPENAI_EMBEDDING_MODEL', 'text-embedding-3-small')
+OPENAI_FALLBACK_MODEL = 'gpt-4o-mini'  # Cost-effective model
+# Routes requests sharing the pinned system prompt to the same OpenAI prompt cache;
+# Azure caches stable prefixes automatically and may reject the unknown parameter
+PROMPT_CACHE_KEY = os.getenv('OPENAI_PROMPT_CACHE_KEY', 'jh_expert_v2')
+ENVIRONMENT = os.getenv('ENVIRONMENT', 'unknown')
+START_TIME = time.monotonic()
 
 # Global variables for AI clients
 azure_client = None
 openai_client = None
-request_count = 0
-error_count = 0
+http_client = None
+clients_initialized = False
+# Health fields that only change when clients are (re)initialized
+client_status: Dict[str, Any] = {}
+_clients_lock = threading.Lock()
+
+class AtomicCounter:
+    """Monotonic counter that is safe to bump from concurrent threads/greenlets"""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+REQUESTS = AtomicCounter('requests', 'Queries sent to the AI response pipeline')
+ERRORS = AtomicCounter('errors', 'AI provider and response generation errors')
+PROMPT_TOKENS = AtomicCounter('prompt_tokens', 'Prompt tokens billed by AI providers')
+CACHED_PROMPT_TOKENS = AtomicCounter('cached_prompt_tokens', 'Prompt tokens served from the provider prompt cache')
+
+# Azure circuit breaker: after repeated failures, route to OpenAI for a cooldown
+AZURE_FAILURE_THRESHOLD = 5
+AZURE_FAILURE_WINDOW = 60
+AZURE_CIRCUIT_COOLDOWN = 30
+azure_consecutive_failures = 0
+azure_first_failure_at = 0.0
+azure_circuit_open_until = 0.0
+azure_circuit_tripped = False
+_circuit_lock = threading.Lock()
+
+# Provider names are shared constants rather than per-response string literals
+PROVIDER_AZURE = 'azure_openai'
+PROVIDER_OPENAI = 'openai'
+PROVIDER_KNOWLEDGE_BASE = 'knowledge_base'
+PROVIDER_NONE = 'none'
+
+@dataclass(frozen=True, slots=True)
+class TokenUsage:
+    """Token accounting for one completion"""
+    prompt_tokens: int
+    completion_tokens: int
+    total_tokens: int
+    cached_tokens: int = 0
+
+@dataclass(frozen=True, slots=True)
+class AIResponse:
+    """Result of a query; immutable so cached instances can be shared across requests"""
+    content: str
+    provider: str
+    model: Optional[str] = None
+    usage: Optional[TokenUsage] = None
+    response_time: float = 0.0
+    error: Optional[str] = None
+    cached: bool = False
+    batched: bool = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        """API body; unset optional fields and false flags are omitted so clients see the original key set"""
+        body = {}
+        for field in fields(self):
+            value = getattr(self, field.name)
+            if value is not None and value is not False:
+                body[field.name] = value
+        return body
+
+class LLMCache:
+    """Two-tier response cache: exact SHA-256 match, then embedding similarity"""
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 3600, similarity_threshold: float = 0.92):
+        self.similarity_threshold = similarity_threshold
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+        # Semantic tier: ring buffer of unit-normalised query embeddings
+        self._maxsize = maxsize
+        self._vectors = None
+        self._vector_keys: List[Optional[str]] = [None] * maxsize
+        self._vector_scopes: List[Optional[str]] = [None] * maxsize
+        self._next_slot = 0
+        self._filled = 0
+
+    @staticmethod
+    def _digest(payload: Any) -> str:
+        return hashlib.sha256(dumps_json(payload, sort_keys=True)).hexdigest()
+
+    @classmethod
+    def cache_key(cls, model: str, messages: List[Dict], temperature: float, max_tokens: int) -> str:
+        """Exact-match key for a chat completion request"""
+        return cls._digest({
+            'model': model,
+            'messages': messages,
+            'temperature': temperature,
+            'max_tokens': max_tokens
+        })
+
+    @classmethod
+    def scope_key(cls, model: str, messages: List[Dict], temperature: float, max_tokens: int) -> str:
+        """Key for everything except the user query, so semantic hits never cross prompts"""
+        return cls._digest({
+            'model': model,
+            'messages': [m for m in messages if m.get('role') != 'user'],
+            'temperature': temperature,
+            'max_tokens': max_tokens
+        })
+
+    def get(self, key: str) -> Optional[AIResponse]:
+        with self._lock:
+            return self._entries.get(key)
+
+    def get_similar(self, scope: str, embedding: Any) -> Optional[AIResponse]:
+        """Return the cached entry whose query embedding is closest above the threshold"""
+        if self._vectors is None:
+            return None
+        query = _normalize_embedding(embedding)
+        with self._lock:
+            if not self._filled or query.shape[0] != self._vectors.shape[1]:
+                return None
+            similarities = self._vectors[:self._filled] @ query
+            for slot in np.argsort(similarities)[::-1]:
+                if similarities[slot] < self.similarity_threshold:
+                    break
+                if self._vector_scopes[slot] != scope:
+                    continue
+                # The vector can outlive its entry; fall through to the next candidate
+                entry = self._entries.get(self._vector_keys[slot])
+                if entry is not None:
+                    return entry
+        return None
+
+    def set(self, key: str, entry: AIResponse, scope: Optional[str] = None, embedding: Any = None):
+        with self._lock:
+            self._entries[key] = entry
+            if scope is None or embedding is None:
+                return
+            vector = _normalize_embedding(embedding)
+            if self._vectors is None or self._vectors.shape[1] != vector.shape[0]:
+                self._vectors = np.zeros((self._maxsize, vector.shape[0]), dtype=np.float32)
+                self._next_slot = 0
+                self._filled = 0
+            slot = self._next_slot
+            self._vectors[slot] = vector
+            self._vector_keys[slot] = key
+            self._vector_scopes[slot] = scope
+            self._next_slot = (slot + 1) % self._maxsize
+            self._filled = min(self._filled + 1, self._maxsize)
+
+def _normalize_embedding(embedding: Any):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+# Cache keys of upstream calls currently in progress, for single-flight coalescing
+SINGLE_FLIGHT_TIMEOUT = 30
+_inflight: Dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+llm_cache = LLMCache(
+    maxsize=int(os.getenv('LLM_CACHE_MAXSIZE', '1024')),
+    ttl=int(os.getenv('LLM_CACHE_TTL', '3600')),
+    similarity_threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.92'))
+)
+
+def get_http_client():
+    """Pooled HTTP client shared by all AI clients so keep-alive connections persist"""
+    global http_client
+    
+    if http_client is None and HTTPX_AVAILABLE:
+        http_client = httpx.Client(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=30),
+            timeout=httpx.Timeout(60.0, connect=5.0)
+        )
+        logger.info(f"HTTP connection pool ready (HTTP/2: {HTTP2_AVAILABLE})")
+    return http_client
 
 def initialize_ai_clients():
     """Initialize AI clients with cloud-optimized configuration"""
@@ -83,13 +435,33 @@ def initialize_ai_clients():
                 azure_client = AzureOpenAI(
                     api_key=api_key,
                     api_version="2024-02-01",
-                    azure_endpoint=endpoint
+                    azure_endpoint=endpoint,
+                    http_client=get_http_client(),
+                    max_retries=0  # retries are handled by create_azure_completion
                 )
                 logger.info("✅ Azure OpenAI initialized with API key")
                 logger.info(f"Azure client type: {type(azure_client)}")
             except Exception as e:
                 logger.error(f"Azure OpenAI initialization failed: {e}")
                 azure_client = None
+        elif endpoint:
+            try:
+                # Managed identity first; skips DefaultAzureCredential's slow CLI/shared-cache probes.
+                # Tokens are fetched on first use and cached by the credential.
+                credential = ChainedTokenCredential(ManagedIdentityCredential(), EnvironmentCredential())
+                azure_client = AzureOpenAI(
+                    azure_ad_token_provider=get_bearer_token_provider(
+                        credential, "https://cognitiveservices.azure.com/.default"
+                    ),
+                    api_version="2024-02-01",
+                    azure_endpoint=endpoint,
+                    http_client=get_http_client(),
+                    max_retries=0  # retries are handled by create_azure_completion
+                )
+                logger.info("✅ Azure OpenAI initialized with managed identity")
+            except Exception as e:
+                logger.error(f"Azure OpenAI initialization failed: {e}")
+                azure_client = None
         else:
             logger.warning("Azure OpenAI credentials not found")
     else:
@@ -102,7 +474,7 @@ def initialize_ai_clients():
         
         if openai_key:
             try:
-                openai_client = openai.OpenAI(api_key=openai_key)
+                openai_client = openai.OpenAI(api_key=openai_key, http_client=get_http_client())
                 logger.info("✅ Standard OpenAI initialized as fallback")
                 logger.info(f"OpenAI client type: {type(openai_client)}")
             except Exception as e:
@@ -115,84 +487,525 @@ def initialize_ai_clients():
     
     logger.info(f"Final status - Azure: {azure_client is not None}, OpenAI: {openai_client is not None}")
     
+    global client_status
+    client_status = {
+        'azure_available': azure_client is not None,
+        'openai_available': openai_client is not None,
+        'debug_info': {
+            'azure_client_type': type(azure_client).__name__ if azure_client else 'None',
+            'openai_client_type': type(openai_client).__name__ if openai_client else 'None'
+        }
+    }
+    
     if not azure_client and not openai_client:
         logger.error("❌ No AI clients available")
     else:
         logger.info(f"✅ {('Azure' if azure_client else '') + (' + ' if azure_client and openai_client else '') + ('OpenAI' if openai_client else '')} client(s) ready")
 
-def generate_response(messages: List[Dict], max_tokens: int = 1500) -> Dict[str, Any]:
+def ensure_clients():
+    """Initialize AI clients on first use, once per worker process"""
+    global clients_initialized
+    
+    if clients_initialized:
+        return
+    with _clients_lock:
+        if not clients_initialized:
+            initialize_ai_clients()
+            clients_initialized = True
+
+def azure_circuit_open() -> bool:
+    """True while Azure is being skipped after repeated failures"""
+    return time.monotonic() < azure_circuit_open_until
+
+def record_azure_success():
+    """Close the circuit and reset the failure window"""
+    global azure_consecutive_failures, azure_circuit_tripped
+    
+    with _circuit_lock:
+        if azure_circuit_tripped:
+            logger.info("✅ Azure OpenAI recovered, circuit closed")
+        azure_consecutive_failures = 0
+        azure_circuit_tripped = False
+
+def _is_azure_outage_error(exc: BaseException) -> bool:
+    """Connection failures, timeouts, throttling and 5xx; request-specific 4xx errors don't count"""
+    if isinstance(exc, openai.APIConnectionError):  # includes APITimeoutError
+        return True
+    return isinstance(exc, openai.APIStatusError) and (exc.status_code == 429 or exc.status_code >= 500)
+
+def record_azure_failure(exc: BaseException):
+    """Count a failed Azure call and open the circuit once the threshold is hit"""
+    global azure_consecutive_failures, azure_first_failure_at, azure_circuit_open_until, azure_circuit_tripped
+    
+    # One user's rejected prompt must not route everyone to the fallback
+    if not _is_azure_outage_error(exc):
+        return
+    
+    with _circuit_lock:
+        now = time.monotonic()
+        if azure_consecutive_failures == 0 or now - azure_first_failure_at > AZURE_FAILURE_WINDOW:
+            azure_consecutive_failures = 0
+            azure_first_failure_at = now
+        azure_consecutive_failures += 1
+        
+        # A failed probe after a cooldown re-opens immediately
+        if azure_circuit_tripped or azure_consecutive_failures >= AZURE_FAILURE_THRESHOLD:
+            azure_circuit_open_until = now + AZURE_CIRCUIT_COOLDOWN
+            azure_circuit_tripped = True
+            logger.warning(f"⚠️ Azure OpenAI circuit open for {AZURE_CIRCUIT_COOLDOWN}s after {azure_consecutive_failures} failure(s)")
+
+def _is_retryable_azure_error(exc: BaseException) -> bool:
+    """Transient Azure throttling/overload responses worth retrying"""
+    return isinstance(exc, openai.APIStatusError) and exc.status_code in (429, 503)
+
+_azure_backoff = wait_random_exponential(min=1, max=20)
+
+def _azure_retry_wait(retry_state) -> float:
+    """Honour Retry-After when Azure sends it, otherwise back off with jitter"""
+    exc = retry_state.outcome.exception()
+    retry_after = getattr(getattr(exc, 'response', None), 'headers', {}).get('retry-after')
+    try:
+        return min(float(retry_after), 20.0)
+    except (TypeError, ValueError):
+        return _azure_backoff(retry_state)
+
+@retry(
+    retry=retry_if_exception(_is_retryable_azure_error),
+    wait=_azure_retry_wait,
+    stop=stop_after_attempt(3),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True
+)
+def create_azure_completion(**kwargs):
+    """Azure chat completion with bounded retries on 429/503"""
+    return azure_client.chat.completions.create(**kwargs)
+
+def record_token_usage(usage) -> TokenUsage:
+    """Count prompt/cached tokens for the metrics and return the usage payload"""
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = (details.get('cached_tokens') if isinstance(details, dict)
+                     else getattr(details, 'cached_tokens', None)) or 0
+    
+    PROMPT_TOKENS.inc(usage.prompt_tokens)
+    CACHED_PROMPT_TOKENS.inc(cached_tokens)
+    return TokenUsage(usage.prompt_tokens, usage.completion_tokens, usage.total_tokens, cached_tokens)
+
+# The semantic tier is an optimisation; never let it hold a request up for long
+EMBEDDING_TIMEOUT = httpx.Timeout(2.0, connect=1.0) if HTTPX_AVAILABLE else 2.0
+
+def get_query_embedding(messages: List[Dict]) -> Optional[Any]:
+    """Embed the latest user message for the semantic cache tier"""
+    if not (NUMPY_AVAILABLE and azure_client) or azure_circuit_open():
+        return None
+    
+    user_query = next((m['content'] for m in reversed(messages) if m.get('role') == 'user'), None)
+    if not user_query:
+        return None
+    
+    try:
+        response = azure_client.embeddings.create(
+            model=AZURE_EMBEDDING_MODEL,
+            input=user_query,
+            timeout=EMBEDDING_TIMEOUT
+        )
+        return response.data[0].embedding
+    except Exception as e:
+        logger.warning(f"Embedding lookup failed, semantic cache skipped: {e}")
+        return None
+
+def lookup_similar_response(chat_model: str, messages: List[Dict], max_tokens: int):
+    """Semantic cache lookup; returns (entry, scope, embedding) for storing on a miss"""
+    embedding = get_query_embedding(messages)
+    if embedding is None:
+        return None, None, None
+    
+    cache_scope = LLMCache.scope_key(chat_model, messages, 0.1, max_tokens)
+    return llm_cache.get_similar(cache_scope, embedding), cache_scope, embedding
+
+def lookup_cached_response(chat_model: str, messages: List[Dict], max_tokens: int):
+    """Exact then semantic cache lookup; returns (entry, key, scope, embedding) for storing on a miss"""
+    cache_key = LLMCache.cache_key(chat_model, messages, 0.1, max_tokens)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached, cache_key, None, None
+    
+    cached, cache_scope, embedding = lookup_similar_response(chat_model, messages, max_tokens)
+    return cached, cache_key, cache_scope, embedding
+
+def generate_response(messages: List[Dict], max_tokens: int = 1500) -> AIResponse:
     """Generate response using available AI client"""
-    global request_count, error_count, azure_client, openai_client
+    global azure_client, openai_client
     
-    request_count += 1
+    ensure_clients()
+    REQUESTS.inc()
     start_time = time.time()
     
-    logger.info(f"🔍 Generate response called - Azure: {'✅' if azure_client else '❌'}, OpenAI: {'✅' if openai_client else '❌'}")
+    logger.info("🔍 Generate response called", extra={
+        'azure_available': azure_client is not None, 'openai_available': openai_client is not None
+    })
+    
+    # Check the response cache before paying for a round-trip
+    cache_key = LLMCache.cache_key(AZURE_CHAT_MODEL, messages, 0.1, max_tokens)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        logger.info("⚡ Serving response from cache")
+        return replace(cached, cached=True, response_time=time.time() - start_time)
+    
+    # Single-flight: identical concurrent requests share the first caller's upstream call
+    with _inflight_lock:
+        leader = _inflight.get(cache_key)
+        if leader is None:
+            future = _inflight[cache_key] = Future()
+    
+    if leader is not None:
+        try:
+            result = leader.result(timeout=SINGLE_FLIGHT_TIMEOUT)
+            logger.info("⚡ Sharing result of an identical in-flight request")
+            return replace(result, cached=True, response_time=time.time() - start_time)
+        except FutureTimeoutError:
+            logger.warning("In-flight request is slow, calling upstream directly")
+            return _generate_uncached(messages, max_tokens, cache_key, start_time)
+    
+    try:
+        result = _generate_uncached(messages, max_tokens, cache_key, start_time)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _inflight_lock:
+            _inflight.pop(cache_key, None)
+
+def _generate_uncached(messages: List[Dict], max_tokens: int, cache_key: str, start_time: float) -> AIResponse:
+    """Semantic cache lookup, then Azure OpenAI with standard OpenAI as fallback"""
+    cached, cache_scope, embedding = lookup_similar_response(AZURE_CHAT_MODEL, messages, max_tokens)
+    if cached is not None:
+        logger.info("⚡ Serving similar response from cache")
+        return replace(cached, cached=True, response_time=time.time() - start_time)
     
-    # Try Azure OpenAI first
-    if azure_client:
+    # Try Azure OpenAI first, unless the circuit is open and a fallback exists
+    if azure_client and not (openai_client and azure_circuit_open()):
         try:
             logger.info("🚀 Using Azure OpenAI for response")
-            response = azure_client.chat.completions.create(
-                model=os.getenv('AZURE_OPENAI_CHAT_MODEL', 'gpt-4'),
+            response = create_azure_completion(
+                model=AZURE_CHAT_MODEL,
                 messages=messages,
                 max_tokens=max_tokens,
                 temperature=0.1
             )
             
-            return {
-                'content': response.choices[0].message.content,
-                'provider': 'azure_openai',
-                'model': response.model,
-                'usage': {
-                    'prompt_tokens': response.usage.prompt_tokens,
-                    'completion_tokens': response.usage.completion_tokens,
-                    'total_tokens': response.usage.total_tokens
-                },
-                'response_time': time.time() - start_time
-            }
+            result = AIResponse(
+                content=response.choices[0].message.content,
+                provider=PROVIDER_AZURE,
+                model=response.model,
+                usage=record_token_usage(response.usage)
+            )
+            record_azure_success()
+            llm_cache.set(cache_key, result, cache_scope, embedding)
+            return replace(result, response_time=time.time() - start_time)
         except Exception as e:
             logger.error(f"Azure OpenAI error: {e}")
-            error_count += 1
+            ERRORS.inc()
+            record_azure_failure(e)
     
     # Fallback to standard OpenAI
     if openai_client:
         try:
             logger.info("🚀 Using Standard OpenAI for response")
             response = openai_client.chat.completions.create(
-                model="gpt-4o-mini",  # Cost-effective model
+                model=OPENAI_FALLBACK_MODEL,
+                extra_body={"prompt_cache_key": PROMPT_CACHE_KEY},
                 messages=messages,
                 max_tokens=max_tokens,
                 temperature=0.1
             )
             
-            return {
-                'content': response.choices[0].message.content,
-                'provider': 'openai',
-                'model': response.model,
-                'usage': {
-                    'prompt_tokens': response.usage.prompt_tokens,
-                    'completion_tokens': response.usage.completion_tokens,
-                    'total_tokens': response.usage.total_tokens
-                },
-                'response_time': time.time() - start_time
-            }
+            result = AIResponse(
+                content=response.choices[0].message.content,
+                provider=PROVIDER_OPENAI,
+                model=response.model,
+                usage=record_token_usage(response.usage)
+            )
+            llm_cache.set(cache_key, result, cache_scope, embedding)
+            return replace(result, response_time=time.time() - start_time)
         except Exception as e:
             logger.error(f"Standard OpenAI error: {e}")
-            error_count += 1
+            ERRORS.inc()
     
     # No AI available
     logger.error("❌ No AI clients available for response generation")
-    error_count += 1
-    return {
-        'content': "I'm temporarily unable to process your request. Please try again later.",
-        'provider': 'none',
-        'error': 'No AI service available',
-        'response_time': time.time() - start_time
-    }
+    ERRORS.inc()
+    return AIResponse(
+        content="I'm temporarily unable to process your request. Please try again later.",
+        provider=PROVIDER_NONE,
+        error='No AI service available',
+        response_time=time.time() - start_time
+    )
+
+def _stream_deltas(response, usage: List[TokenUsage]):
+    """Text deltas from a streamed chat completion, skipping empty/filter chunks; token usage is appended to usage"""
+    for chunk in response:
+        if getattr(chunk, 'usage', None):
+            usage.append(record_token_usage(chunk.usage))
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.model, chunk.choices[0].delta.content
+
+def generate_response_stream(messages: List[Dict], max_tokens: int = 1500):
+    """Stream a response as event dicts: {'delta': ...} chunks, then a final {'done': True, ...}"""
+    ensure_clients()
+    REQUESTS.inc()
+    start_time = time.time()
+    
+    cached, cache_key, cache_scope, embedding = lookup_cached_response(AZURE_CHAT_MODEL, messages, max_tokens)
+    if cached is not None:
+        logger.info("⚡ Serving streamed response from cache")
+        yield {'delta': cached.content}
+        yield {'done': True, 'provider': cached.provider, 'model': cached.model,
+               'cached': True, 'response_time': time.time() - start_time}
+        return
+    
+    providers = []
+    if azure_client and not (openai_client and azure_circuit_open()):
+        providers.append((PROVIDER_AZURE, lambda: create_azure_completion(
+            model=AZURE_CHAT_MODEL, messages=messages, max_tokens=max_tokens, temperature=0.1, stream=True
+        )))
+    if openai_client:
+        # Azure api-version 2024-02-01 has no stream_options, so only the fallback reports streamed usage
+        providers.append((PROVIDER_OPENAI, lambda: openai_client.chat.completions.create(
+            model=OPENAI_FALLBACK_MODEL, messages=messages, max_tokens=max_tokens, temperature=0.1, stream=True,
+            stream_options={"include_usage": True}, extra_body={"prompt_cache_key": PROMPT_CACHE_KEY}
+        )))
+    
+    for provider, create in providers:
+        parts = []
+        usage = []
+        model = None
+        try:
+            logger.info("🚀 Streaming response", extra={'provider': provider})
+            for model, delta in _stream_deltas(create(), usage):
+                parts.append(delta)
+                yield {'delta': delta}
+        except Exception as e:
+            logger.error(f"{provider} streaming error: {e}")
+            ERRORS.inc()
+            if provider == PROVIDER_AZURE:
+                record_azure_failure(e)
+            if parts:
+                # Tokens already reached the client, so a fallback would duplicate text
+                yield {'done': True, 'provider': provider, 'error': 'Stream interrupted',
+                       'response_time': time.time() - start_time}
+                return
+            continue
+        
+        if provider == PROVIDER_AZURE:
+            record_azure_success()
+        result = AIResponse(content=''.join(parts), provider=provider, model=model,
+                            usage=usage[0] if usage else None)
+        llm_cache.set(cache_key, result, cache_scope, embedding)
+        yield {'done': True, 'provider': provider, 'model': model, 'response_time': time.time() - start_time}
+        return
+    
+    logger.error("❌ No AI clients available for response generation")
+    ERRORS.inc()
+    yield {'delta': "I'm temporarily unable to process your request. Please try again later."}
+    yield {'done': True, 'provider': PROVIDER_NONE, 'error': 'No AI service available',
+           'response_time': time.time() - start_time}
+
+def sse_response(events) -> Response:
+    """Send event dicts to the client as Server-Sent Events"""
+    return Response(
+        stream_with_context(b"data: " + dumps_json(event) + b"\n\n" for event in events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+_BATCH_INSTRUCTIONS = (
+    "Answer each numbered question below independently, as if it were asked on its own. "
+    "Reply with only a JSON object of the form {\"answers\": [\"...\", ...]} containing exactly "
+    "%d strings, in the same order as the questions."
+)
+
+def _parse_batch_answers(content: Optional[str], expected: int) -> Optional[List[str]]:
+    """Extract the per-question answers from a batched completion, or None if malformed"""
+    if not content:
+        return None
+    start, end = content.find('{'), content.rfind('}')
+    try:
+        answers = loads_json(content[start:end + 1]).get('answers')
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(answers, list) or len(answers) != expected or not all(isinstance(a, str) for a in answers):
+        return None
+    return answers
+
+# Completion budget for one batched call; batches are sized so every answer keeps its own max_tokens
+BATCH_MAX_TOKENS = 4096
+
+def generate_batched_responses(prefix_messages: List[Dict], queries: List[str], max_tokens: int) -> Optional[List[AIResponse]]:
+    """Answer several user queries with a single chat completion; None if the batch failed"""
+    ensure_clients()
+    start_time = time.time()
+    prompt = _BATCH_INSTRUCTIONS % len(queries) + "\n\n" + "\n".join(
+        f"{i+1}. {query}" for i, query in enumerate(queries)
+    )
+    messages = [*prefix_messages, {"role": "user", "content": prompt}]
+    batch_max_tokens = max_tokens * len(queries)
+    
+    providers = []
+    if azure_client and not (openai_client and azure_circuit_open()):
+        providers.append((PROVIDER_AZURE, lambda: create_azure_completion(
+            model=AZURE_CHAT_MODEL, messages=messages,
+            max_tokens=batch_max_tokens, temperature=0.1
+        )))
+    if openai_client:
+        providers.append((PROVIDER_OPENAI, lambda: openai_client.chat.completions.create(
+            model=OPENAI_FALLBACK_MODEL, messages=messages, max_tokens=batch_max_tokens, temperature=0.1,
+            extra_body={"prompt_cache_key": PROMPT_CACHE_KEY}
+        )))
+    
+    for provider, create in providers:
+        try:
+            logger.info("🚀 Batching queries", extra={'provider': provider, 'batch_size': len(queries)})
+            response = create()
+        except Exception as e:
+            logger.error(f"{provider} batch error: {e}")
+            ERRORS.inc()
+            if provider == PROVIDER_AZURE:
+                record_azure_failure(e)
+            continue
+        
+        if provider == PROVIDER_AZURE:
+            record_azure_success()
+        record_token_usage(response.usage)
+        answers = _parse_batch_answers(response.choices[0].message.content, len(queries))
+        if answers is None:
+            logger.warning("Batched completion was malformed, answering individually")
+            return None
+        
+        response_time = time.time() - start_time
+        return [
+            AIResponse(content=answer, provider=provider, model=response.model,
+                       response_time=response_time, batched=True)
+            for answer in answers
+        ]
+    
+    return None
+
+class QueryBatcher:
+    """Coalesce concurrent /api/query calls into one multi-question completion"""
+
+    def __init__(self, max_batch: int = 8, max_wait: float = 0.025):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=32)
+        self._lock = threading.Lock()
+        self._worker_pid = None
+
+    def submit(self, messages: List[Dict], max_tokens: int = 1500) -> Future:
+        """Queue a conversation ending in a user message; the future resolves to an AIResponse"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((messages, max_tokens, future))
+        return future
+
+    def _ensure_worker(self):
+        # Threads don't survive gunicorn's fork, so start one lazily in each worker process
+        if self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker_pid != os.getpid():
+                threading.Thread(target=self._run, name='query-batcher', daemon=True).start()
+                self._worker_pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            # Only conversations sharing a prompt prefix and token budget can share a request
+            groups: Dict[Any, List] = {}
+            for item in batch:
+                messages, max_tokens, _ = item
+                groups.setdefault((dumps_json(messages[:-1], sort_keys=True), max_tokens), []).append(item)
+            for items in groups.values():
+                self._executor.submit(self._dispatch, items)
+
+    def _answer_individually(self, items: List):
+        for messages, max_tokens, future in items:
+            self._executor.submit(self._resolve, future, generate_response, messages, max_tokens)
+
+    @staticmethod
+    def _resolve(future: Future, fn, *args):
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _dispatch(self, items: List):
+        pending = []
+        for messages, max_tokens, future in items:
+            cache_key = LLMCache.cache_key(AZURE_CHAT_MODEL, messages, 0.1, max_tokens)
+            cached = llm_cache.get(cache_key)
+            if cached is not None:
+                REQUESTS.inc()
+                future.set_result(replace(cached, cached=True, response_time=0.0))
+            else:
+                pending.append((messages, max_tokens, future))
+        
+        if not pending:
+            return
+        
+        # A truncated JSON reply would be rejected and re-asked, so never exceed the token cap
+        per_batch = max(BATCH_MAX_TOKENS // pending[0][1], 1)
+        for i in range(0, len(pending), per_batch):
+            self._dispatch_batch(pending[i:i + per_batch])
+
+    def _dispatch_batch(self, pending: List):
+        if len(pending) < 2:
+            self._answer_individually(pending)
+            return
+        
+        try:
+            results = generate_batched_responses(
+                pending[0][0][:-1], [p[0][-1]['content'] for p in pending], pending[0][1]
+            )
+        except Exception as e:
+            logger.error(f"Query batch failed: {e}")
+            results = None
+        if results is None:
+            self._answer_individually(pending)
+            return
+        
+        # Batched answers share a prompt with other users' questions, so they are never cached
+        REQUESTS.inc(len(pending))
+        for (_, _, future), result in zip(pending, results):
+            future.set_result(result)
+
+# Opt-in: batching trades up to max_wait of latency for fewer upstream requests under RPM pressure
+QUERY_BATCHING_ENABLED = os.getenv('QUERY_BATCHING_ENABLED', 'false').lower() == 'true'
+query_batcher = QueryBatcher()
+
+def _freeze(value):
+    """Recursively convert dicts/lists to read-only MappingProxyType/tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
 
 # Simple in-memory knowledge base for quick responses
-JAMES_HARDIE_KNOWLEDGE = {
+JAMES_HARDIE_KNOWLEDGE = _freeze({
     'hardieplank': {
         'description': 'HardiePlank® lap siding is a fiber cement siding that combines the look of wood with superior durability and performance.',
         'installation': [
@@ -222,36 +1035,136 @@ JAMES_HARDIE_KNOWLEDGE = {
         'Prime and paint all cut edges within 60 days',
         'Store materials flat and off the ground'
     ]
+})
+
+# System prompts are built once; the message dicts are shared, never mutated
+_SYSTEM_PROMPT = (
+    "You are a James Hardie technical expert. Answer questions on HardiePlank® lap siding, "
+    "HardieTrim® boards, HardiePanel® vertical siding and HardieSoffit® panels: installation, "
+    "specifications, tools, fasteners, troubleshooting, code compliance and safety. Be concise "
+    "and accurate. Always recommend following local building codes and manufacturer instructions."
+)
+_SYSTEM_MESSAGE = {"role": "system", "content": _SYSTEM_PROMPT}
+_TEST_SYSTEM_MESSAGE = {"role": "system", "content": "You are a James Hardie technical expert."}
+
+# Quick-answer responses, joined once at import instead of per request
+_PLANK_INSTALL_RESP = "HardiePlank installation key steps:\n" + "\n".join(
+    f"{i+1}. {step}" for i, step in enumerate(JAMES_HARDIE_KNOWLEDGE['hardieplank']['installation'])
+)
+_PLANK_TOOLS_RESP = f"Tools needed for HardiePlank installation: {', '.join(JAMES_HARDIE_KNOWLEDGE['hardieplank']['tools'])}"
+_GENERAL_INSTALL_RESP = "General James Hardie installation guidelines:\n" + "\n".join(
+    f"• {step}" for step in JAMES_HARDIE_KNOWLEDGE['installation_general']
+)
+
+# Keyword -> tag; 'install' also covers 'installation'. Only the hardieplank, hardietrim,
+# install and tool tags drive quick answers; the rest just select knowledge-base context
+# for AI queries and must never share a quick-answer tag ("I saw cracks" is not a tools question).
+KNOWLEDGE_KEYWORDS = {
+    'hardieplank': 'hardieplank',
+    'hardietrim': 'hardietrim',
+    'install': 'install',
+    'tool': 'tool',
+    'saw': 'cutting',
+    'blade': 'cutting',
+    'fastener': 'fasteners',
+    'nail': 'fasteners',
+    'screw': 'fasteners',
+    'clearance': 'general',
+    'flashing': 'general',
+    'primer': 'general',
+    'paint': 'general',
+    'building code': 'general'
 }
 
-def get_quick_answer(query: str) -> Optional[str]:
-    """Get quick answer from knowledge base"""
-    query_lower = query.lower()
-    
-    if 'hardieplank' in query_lower:
-        if 'install' in query_lower:
-            steps = JAMES_HARDIE_KNOWLEDGE['hardieplank']['installation']
-            return f"HardiePlank installation key steps:\n" + "\n".join(f"{i+1}. {step}" for i, step in enumerate(steps))
-        elif 'tool' in query_lower:
-            tools = JAMES_HARDIE_KNOWLEDGE['hardieplank']['tools']
-            return f"Tools needed for HardiePlank installation: {', '.join(tools)}"
-        else:
-            return JAMES_HARDIE_KNOWLEDGE['hardieplank']['description']
-    
-    elif 'hardietrim' in query_lower:
-        return JAMES_HARDIE_KNOWLEDGE['hardietrim']['description']
+# Each tag is one bit, so a match pass folds into a small int instead of a set
+KEYWORD_TAG_BITS = {tag: 1 << i for i, tag in enumerate(dict.fromkeys(KNOWLEDGE_KEYWORDS.values()))}
+
+def _build_keyword_matcher():
+    """Compile all keywords into a single-pass matcher returning a bitmask of matched tags"""
+    if AHOCORASICK_AVAILABLE:
+        automaton = ahocorasick.Automaton()
+        for keyword, tag in KNOWLEDGE_KEYWORDS.items():
+            automaton.add_word(keyword, KEYWORD_TAG_BITS[tag])
+        automaton.make_automaton()
+        
+        def match(text: str) -> int:
+            mask = 0
+            for _, bit in automaton.iter(text):
+                mask |= bit
+            return mask
+        return match
     
-    elif any(word in query_lower for word in ['install', 'installation']):
-        steps = JAMES_HARDIE_KNOWLEDGE['installation_general']
-        return "General James Hardie installation guidelines:\n" + "\n".join(f"• {step}" for step in steps)
+    keyword_bits = {keyword: KEYWORD_TAG_BITS[tag] for keyword, tag in KNOWLEDGE_KEYWORDS.items()}
+    pattern = re.compile('|'.join(re.escape(k) for k in sorted(keyword_bits, key=len, reverse=True)))
     
+    def match(text: str) -> int:
+        mask = 0
+        for keyword in pattern.findall(text):
+            mask |= keyword_bits[keyword]
+        return mask
+    return match
+
+def _select_quick_answer(mask: int) -> Optional[str]:
+    """Priority rules for the quick-answer path"""
+    tags = {tag for tag, bit in KEYWORD_TAG_BITS.items() if mask & bit}
+    if 'hardieplank' in tags:
+        if 'install' in tags:
+            return _PLANK_INSTALL_RESP
+        if 'tool' in tags:
+            return _PLANK_TOOLS_RESP
+        return JAMES_HARDIE_KNOWLEDGE['hardieplank']['description']
+    if 'hardietrim' in tags:
+        return JAMES_HARDIE_KNOWLEDGE['hardietrim']['description']
+    if 'install' in tags:
+        return _GENERAL_INSTALL_RESP
     return None
 
-# Routes
-@app.route('/')
-def home():
-    """Home page with simple interface"""
-    html = """
+match_keywords = _build_keyword_matcher()
+
+# Every tag combination resolved up front, so a request is one tuple index
+_QUICK_ANSWERS = tuple(_select_quick_answer(mask) for mask in range(1 << len(KEYWORD_TAG_BITS)))
+
+# Short knowledge-base facts sent alongside AI queries that mention a related topic
+_PLANK_TOOLS_FACT = f"HardiePlank tools: {', '.join(JAMES_HARDIE_KNOWLEDGE['hardieplank']['tools'])}"
+_CONTEXT_BY_TAG = {
+    'tool': _PLANK_TOOLS_FACT,
+    'cutting': _PLANK_TOOLS_FACT,
+    'fasteners': f"HardiePlank fasteners: {JAMES_HARDIE_KNOWLEDGE['hardieplank']['fasteners']}",
+    'general': "General guidelines: " + "; ".join(JAMES_HARDIE_KNOWLEDGE['installation_general'])
+}
+
+def _build_context_message(mask: int) -> Optional[Dict[str, str]]:
+    facts = list(dict.fromkeys(fact for tag, fact in _CONTEXT_BY_TAG.items() if mask & KEYWORD_TAG_BITS[tag]))
+    if not facts:
+        return None
+    return {"role": "system", "content": "Reference facts:\n" + "\n".join(f"- {fact}" for fact in facts)}
+
+# Built once per tag combination so identical topics send byte-identical messages
+_CONTEXT_MESSAGES = tuple(_build_context_message(mask) for mask in range(1 << len(KEYWORD_TAG_BITS)))
+
+_SHORT_ANSWER_PATTERN = re.compile(r"\b(what is|what's|define)\b", re.IGNORECASE)
+_HOW_TO_PATTERN = re.compile(r"install|\bhow\b", re.IGNORECASE)
+
+def choose_max_tokens(query: str) -> int:
+    """Size the completion budget to the question; generation time scales with it"""
+    if len(query) < 80 and _SHORT_ANSWER_PATTERN.search(query):
+        return 300
+    if _HOW_TO_PATTERN.search(query):
+        return 800
+    return 1500
+
+def build_messages(query: str) -> List[Dict[str, str]]:
+    """Stable system prompt first (prompt-cache prefix), then any matching facts, then the query"""
+    context = _CONTEXT_MESSAGES[match_keywords(query.lower())]
+    user_message = {"role": "user", "content": query}
+    return [_SYSTEM_MESSAGE, context, user_message] if context else [_SYSTEM_MESSAGE, user_message]
+
+def get_quick_answer(query: str) -> Optional[str]:
+    """Get quick answer from knowledge base"""
+    # str.lower() is a single C-level pass; matching on the result is the only other scan
+    return _QUICK_ANSWERS[match_keywords(query.lower())]
+
+HOME_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -282,9 +1195,10 @@ def home():
             
             <h3>API Endpoints:</h3>
             <ul>
-                <li><strong>POST /api/query</strong> - Ask technical questions</li>
+                <li><strong>POST /api/query</strong> - Ask technical questions (send <code>"stream": true</code> for Server-Sent Events)</li>
                 <li><strong>GET /api/health</strong> - Health check</li>
                 <li><strong>GET /api/metrics</strong> - Performance metrics</li>
+                <li><strong>GET /metrics</strong> - Prometheus metrics</li>
             </ul>
             
             <h3>Quick Test:</h3>
@@ -303,18 +1217,45 @@ def home():
                     const response = await fetch('/api/query', {
                         method: 'POST',
                         headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ query: query })
+                        body: JSON.stringify({ query: query, stream: true })
                     });
-                    
-                    const data = await response.json();
-                    
-                    document.getElementById('status').innerText = 
-                        `Response from ${data.provider || 'unknown'} in ${(data.response_time || 0).toFixed(2)}s`;
-                    
-                    document.getElementById('response').innerHTML = 
-                        `<strong>Q:</strong> ${query}<br><br><strong>A:</strong> ${data.content || data.error}`;
-                    document.getElementById('response').style.display = 'block';
-                    
+
+                    if (!response.ok) {
+                        const data = await response.json();
+                        throw new Error(data.error || response.statusText);
+                    }
+
+                    // Render Server-Sent Events as they arrive
+                    const reader = response.body.getReader();
+                    const decoder = new TextDecoder();
+                    let buffer = '';
+                    let answer = '';
+
+                    while (true) {
+                        const { value, done } = await reader.read();
+                        if (done) break;
+
+                        buffer += decoder.decode(value, { stream: true });
+                        const events = buffer.split('\\n\\n');
+                        buffer = events.pop();
+
+                        for (const event of events) {
+                            if (!event.startsWith('data: ')) continue;
+                            const data = JSON.parse(event.slice(6));
+
+                            if (data.delta) answer += data.delta;
+                            if (data.done) {
+                                document.getElementById('status').innerText =
+                                    `Response from ${data.provider || 'unknown'} in ${(data.response_time || 0).toFixed(2)}s`;
+                                if (data.error && !answer) answer = data.error;
+                            }
+
+                            document.getElementById('response').innerHTML =
+                                `<strong>Q:</strong> ${query}<br><br><strong>A:</strong> ${answer}`;
+                            document.getElementById('response').style.display = 'block';
+                        }
+                    }
+
                 } catch (error) {
                     document.getElementById('status').innerText = 'Error: ' + error.message;
                 }
@@ -343,16 +1284,39 @@ def home():
     </body>
     </html>
     """
-    return html
+
+# Home page is static: encode, compress and fingerprint it once
+_HOME_HTML = HOME_HTML.encode('utf-8')
+_HOME_HTML_GZIP = gzip.compress(_HOME_HTML, mtime=0)
+_HOME_ETAG = hashlib.md5(_HOME_HTML, usedforsecurity=False).hexdigest()
+_HOME_GZIP_ETAG = _HOME_ETAG + '-gzip'
+_HOME_HEADERS = {
+    'Cache-Control': 'public, max-age=3600',
+    'ETag': f'"{_HOME_ETAG}"',
+    'Vary': 'Accept-Encoding'
+}
+_HOME_GZIP_HEADERS = {**_HOME_HEADERS, 'ETag': f'"{_HOME_GZIP_ETAG}"', 'Content-Encoding': 'gzip'}
+
+# Routes
+@app.route('/')
+def home():
+    """Home page with simple interface"""
+    gzipped = 'gzip' in request.accept_encodings
+    headers = _HOME_GZIP_HEADERS if gzipped else _HOME_HEADERS
+    if request.if_none_match.contains(_HOME_ETAG) or request.if_none_match.contains(_HOME_GZIP_ETAG):
+        return Response(status=304, headers=headers)
+    return Response(_HOME_HTML_GZIP if gzipped else _HOME_HTML, mimetype='text/html', headers=headers)
 
 @app.route('/api/reinit')
 def reinit_clients():
     """Reinitialize AI clients for testing"""
-    global azure_client, openai_client
-    azure_client = None
-    openai_client = None
+    global azure_client, openai_client, clients_initialized
     
-    initialize_ai_clients()
+    with _clients_lock:
+        azure_client = None
+        openai_client = None
+        initialize_ai_clients()
+        clients_initialized = True
     
     return jsonify({
         'message': 'AI clients reinitialized',
@@ -361,36 +1325,52 @@ def reinit_clients():
         'timestamp': datetime.now().isoformat()
     })
 
-@app.route('/api/health')
+# Load balancers probe these endpoints constantly: only counters and the clock
+# are filled in per call, and the body is encoded straight to bytes
+_HEALTH_STATIC = {'status': 'healthy', 'environment': ENVIRONMENT}
+
+@app.route('/api/health', provide_automatic_options=False)
 def health():
     """Health check endpoint"""
-    global azure_client, openai_client, request_count, error_count
-    
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': datetime.now().isoformat(),
-        'azure_available': azure_client is not None,
-        'openai_available': openai_client is not None,
-        'requests_processed': request_count,
-        'error_count': error_count,
-        'environment': os.getenv('ENVIRONMENT', 'unknown'),
-        'debug_info': {
-            'azure_client_type': type(azure_client).__name__ if azure_client else 'None',
-            'openai_client_type': type(openai_client).__name__ if openai_client else 'None'
-        }
-    })
+    ensure_clients()
+    return Response(dumps_json({
+        **_HEALTH_STATIC,
+        **client_status,
+        'requests_processed': REQUESTS.value,
+        'error_count': ERRORS.value,
+        'ts': int(time.time())
+    }), mimetype='application/json')
 
-@app.route('/api/metrics')
+@app.route('/api/metrics', provide_automatic_options=False)
 def metrics():
     """Performance metrics endpoint"""
-    return jsonify({
-        'requests_processed': request_count,
-        'error_count': error_count,
-        'error_rate': error_count / max(request_count, 1),
-        'uptime': time.time(),
-        'azure_configured': azure_client is not None,
-        'openai_configured': openai_client is not None
-    })
+    ensure_clients()
+    return Response(dumps_json({
+        'requests_processed': REQUESTS.value,
+        'error_count': ERRORS.value,
+        'error_rate': ERRORS.value / max(REQUESTS.value, 1),
+        'prompt_tokens': PROMPT_TOKENS.value,
+        'cached_prompt_tokens': CACHED_PROMPT_TOKENS.value,
+        'prompt_cache_hit_rate': CACHED_PROMPT_TOKENS.value / max(PROMPT_TOKENS.value, 1),
+        'uptime': time.monotonic() - START_TIME,
+        'azure_configured': client_status['azure_available'],
+        'openai_configured': client_status['openai_available']
+    }), mimetype='application/json')
+
+if PROMETHEUS_AVAILABLE:
+    class _CounterCollector:
+        """Expose the in-process AtomicCounters to Prometheus without double bookkeeping"""
+
+        def collect(self):
+            for counter in (REQUESTS, ERRORS, PROMPT_TOKENS, CACHED_PROMPT_TOKENS):
+                yield CounterMetricFamily(f'jh_expert_{counter.name}', counter.documentation, value=counter.value)
+
+    REGISTRY.register(_CounterCollector())
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        """Prometheus scrape endpoint"""
+        return Response(generate_latest(REGISTRY), mimetype=CONTENT_TYPE_LATEST)
 
 @app.route('/api/query', methods=['POST'])
 def api_query():
@@ -403,46 +1383,35 @@ def api_query():
         user_query = data['query'].strip()
         if not user_query:
             return jsonify({'error': 'Empty query'}), 400
+        stream = bool(data.get('stream'))
         
         # Try quick answer first
         quick_answer = get_quick_answer(user_query)
+        if quick_answer and stream:
+            return sse_response([
+                {'delta': quick_answer},
+                {'done': True, 'provider': PROVIDER_KNOWLEDGE_BASE, 'response_time': 0.01, 'cached': True}
+            ])
         if quick_answer:
-            return jsonify({
-                'content': quick_answer,
-                'provider': 'knowledge_base',
-                'response_time': 0.01,
-                'cached': True
-            })
+            return jsonify(AIResponse(
+                content=quick_answer,
+                provider=PROVIDER_KNOWLEDGE_BASE,
+                response_time=0.01,
+                cached=True
+            ).to_dict())
         
         # Use AI for complex queries
-        messages = [
-            {
-                "role": "system",
-                "content": """You are a James Hardie technical expert assistant. Provide accurate, helpful information about James Hardie products including:
-
-- HardiePlank® lap siding
-- HardieTrim® boards  
-- HardiePanel® vertical siding
-- HardieSoffit® panels
-
-Focus on:
-- Installation procedures and best practices
-- Product specifications and compatibility
-- Tools and fasteners required
-- Troubleshooting common issues
-- Building code compliance
-- Safety considerations
-
-Keep responses concise but comprehensive. Always recommend following local building codes and manufacturer instructions."""
-            },
-            {
-                "role": "user",
-                "content": user_query
-            }
-        ]
+        messages = build_messages(user_query)
+        max_tokens = choose_max_tokens(user_query)
+        
+        if stream:
+            return sse_response(generate_response_stream(messages, max_tokens))
         
-        response = generate_response(messages)
-        return jsonify(response)
+        if QUERY_BATCHING_ENABLED:
+            response = query_batcher.submit(messages, max_tokens).result(timeout=300)
+        else:
+            response = generate_response(messages, max_tokens)
+        return jsonify(response.to_dict())
         
     except Exception as e:
         logger.error(f"Query processing error: {e}")
@@ -466,20 +1435,17 @@ def test_endpoints():
                 results.append({
                     'query': query,
                     'response': quick_answer[:100] + '...',
-                    'provider': 'knowledge_base',
+                    'provider': PROVIDER_KNOWLEDGE_BASE,
                     'status': 'success'
                 })
             else:
-                messages = [
-                    {"role": "system", "content": "You are a James Hardie technical expert."},
-                    {"role": "user", "content": query}
-                ]
+                messages = [_TEST_SYSTEM_MESSAGE, {"role": "user", "content": query}]
                 response = generate_response(messages, max_tokens=100)
                 results.append({
                     'query': query,
-                    'response': response['content'][:100] + '...',
-                    'provider': response['provider'],
-                    'status': 'success' if 'error' not in response else 'failed'
+                    'response': response.content[:100] + '...',
+                    'provider': response.provider,
+                    'status': 'success' if response.error is None else 'failed'
                 })
         except Exception as e:
             results.append({
@@ -494,10 +1460,8 @@ def test_endpoints():
         'passed': len([r for r in results if r['status'] == 'success'])
     })
 
-# Initialize AI clients on startup
-initialize_ai_clients()
-
 if __name__ == '__main__':
+    ensure_clients()
     port = int(os.environ.get('PORT', 8000))
     debug = os.environ.get('FLASK_DEBUG', 'false').lower() == 'true'
     